@@ -13,110 +13,207 @@
 # the function code.
 
 import argparse
+import concurrent.futures
+import contextlib
+import gzip
+import io
 import logging
 import os
-import platform
 import shutil
+import stat
 import subprocess
+import sys
 import tarfile
-import time
-from distutils.dir_util import copy_tree
+import tempfile
+import zipfile
 
+# Buffer size used when copying file contents into archives and buffering archive output. tarfile defaults to 16 KiB
+# and zipfile to 8 KiB, which means thousands of small reads and writes for the compiled binary.
+COPY_BUFSIZE = 4 * 1024 * 1024
 
-def create_directory(dir_name):
+# Minimum free space on /dev/shm for it to be used for staging. Docker limits /dev/shm to 64 MiB by default, which is
+# not enough for the parallel builds' binaries.
+MIN_SHM_FREE_SPACE = 1024 * 1024 * 1024
+
+# Parallel gzip implementation used to compress the tarballs when available on the host.
+PIGZ = shutil.which("pigz")
+
+
+def list_documentation_files():
+    """
+    Lists the top-level documentation files present in the current directory with a single directory scan, so the
+    result can be reused for every target instead of checking each file again.
+
+    :return: The names of the documentation files to package with the binaries.
+    """
+    with os.scandir(".") as entries:
+        present_files = {entry.name for entry in entries if entry.is_file()}
+    return [file_name for file_name in ["README.md", "LICENSE", "CHANGELOG.md", "GETTING_STARTED.md"]
+            if file_name in present_files]
+
+
+def link_or_copy(src, dst):
+    """
+    Hard links a file to the destination, falling back to a copy when the file system does not support hard links or
+    the destination is on a different device. An existing destination file is replaced.
+
+    :type src: str
+    :param src: The path of the source file.
+    :type dst: str
+    :param dst: The destination file or directory.
+    :return: The path of the destination file.
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def staging_parent_dir():
+    """
+    Chooses where the per-target staging directories are created. The CI runner's temporary directory is preferred,
+    then /dev/shm so the binaries are staged in memory where a tmpfs with at least MIN_SHM_FREE_SPACE free is
+    available, and finally the system default.
+
+    :return: The parent directory for staging directories, or None to use the system default.
     """
-    Creates a temporary directory to store the compiled binary, and copies the necessary documentation to the directory.
+    if os.environ.get("RUNNER_TEMP"):
+        return os.environ["RUNNER_TEMP"]
+    if os.path.isdir("/dev/shm") and shutil.disk_usage("/dev/shm").free >= MIN_SHM_FREE_SPACE:
+        return "/dev/shm"
+    return None
+
+
+def stage_documentation(dir_name, documentation_files):
+    """
+    Copies README.md, LICENSE, CHANGELOG.md, and documentation to a directory once, so every target can link the
+    documentation from there instead of copying it from the source tree again.
+
+    :type dir_name: str
+    :param dir_name: The name of the documentation staging directory.
+    :type documentation_files: list
+    :param documentation_files: The top-level documentation files to copy to the directory.
+    :return: None
+    """
+    # The staging directory's permissions are copied to every target directory, and mkdtemp creates it as 0700.
+    os.chmod(dir_name, 0o755)
+    logging.debug("Copying README.md, LICENSE, CHANGELOG.md, and documentation to directory " + dir_name)
+    for file_name in documentation_files:
+        link_or_copy(file_name, dir_name)
+    shutil.copytree("documentation", os.path.join(dir_name, "documentation"), dirs_exist_ok=True,
+                    copy_function=link_or_copy)
+
+
+def create_directory(dir_name, documentation_dir):
+    """
+    Creates a temporary directory to store the compiled binary, and links the staged documentation into the directory.
 
     :type dir_name: str
     :param dir_name: The name of the temporary directory.
+    :type documentation_dir: str
+    :param documentation_dir: The directory containing the staged documentation.
     :return: None
     """
-    if not os.path.exists(dir_name):
-        logging.debug("Creating temporary directory " + dir_name + " for compiled binary.")
-        os.mkdir(dir_name)
+    logging.debug("Creating temporary directory " + dir_name + " for compiled binary.")
+    shutil.copytree(documentation_dir, dir_name, dirs_exist_ok=True, copy_function=link_or_copy)
 
-    logging.debug("Copying README.md, LICENSE, CHANGELOG.md, and documentation to directory " + dir_name)
-    for file_name in ["README.md", "LICENSE", "CHANGELOG.md", "GETTING_STARTED.md"]:
-        if os.path.isfile(file_name):
-            shutil.copy(file_name, dir_name)
-    copy_tree("documentation", dir_name + "/documentation")
 
+def download_modules():
+    """
+    Downloads and verifies the Go module dependencies once before the parallel builds start, so the builds for the
+    different targets only compile and link against the shared module and build caches.
 
-def run_build(target_bin):
+    :return: None
     """
-    Compiles a binary for the target OS.
+    download_command = ["go", "mod", "download"]
+    logging.debug("Downloading Go modules with command: " + " ".join(download_command))
+    subprocess.run(download_command, check=True, capture_output=True)
 
+
+def run_build(dir_name, target_bin, arch):
+    """
+    Compiles a binary for the target OS and architecture.
+
+    GOOS and GOARCH are passed to the build through its own environment rather than by mutating os.environ, so builds
+    for different targets can safely run in parallel.
+
+    :type dir_name: str
+    :param dir_name: The directory to write the binary to.
     :type target_bin: str
     :param target_bin: The target OS for the binary.
+    :type arch: str
+    :param arch: The target architecture for the binary.
     :return: The name of the binary.
     """
-    os.environ['GOOS'] = target_bin
-    arch = "amd64"
-    os.environ['GOARCH'] = arch
-
-    if os.getenv('GOOS') is None or os.getenv('GOARCH') is None:
-        logging.error("Environment variables GOOS or GOARCH are not set.")
-        return None
+    # CGO is disabled so cross-compiled binaries are pure Go and do not depend on a C toolchain for the target.
+    build_env = dict(os.environ, GOOS=target_bin, GOARCH=arch, CGO_ENABLED="0")
 
     # Required for Lambda runtime platform.al2023
     file_name = "bootstrap"
 
-    build_command = "go build -o {}/{}".format(target_bin, file_name)
+    # Strip the symbol table and DWARF debug information to shrink the binary and every archive it is packaged in.
+    output_path = os.path.join(dir_name, file_name)
     if target_bin == "windows":
-        build_command += ".exe"
-    logging.debug("Compiling binary for {} with command: {}".format(target_bin, build_command))
-    subprocess.Popen(build_command, shell=True, stdout=subprocess.PIPE)
-    return file_name
+        output_path += ".exe"
 
-
-def check_binary(dir_name, binary):
-    """
-    Check the directory to make sure the binary has been compiled.
-
-    :param dir_name: The name of the directory.
-    :param binary: The name of the compiled binary.
-    :return: None
-    """
-    if dir_name == "windows":
-        binary += ".exe"
-    check_file(dir_name + "/" + binary)
+    build_command = ["go", "build", "-trimpath", "-buildvcs=false", "-ldflags=-s -w", "-o", output_path]
+    logging.debug("Compiling binary for {}/{} with command: {}".format(target_bin, arch, " ".join(build_command)))
+    subprocess.run(build_command, check=True, capture_output=True, env=build_env)
+    return file_name
 
 
-def check_file(file_name):
+def scan_files(dir_name, prefix=""):
     """
-    Check whether the file has been created.
+    Recursively scans a directory for regular files.
 
-    :type file_name: str
-    :param file_name: The name of the file to check.
-    :return:
+    :type dir_name: str
+    :param dir_name: The name of the directory to scan.
+    :type prefix: str
+    :param prefix: The archive path of the directory, prepended to the archive path of every file.
+    :return: A generator of (os.DirEntry, str) tuples, one for each file in the directory tree, where the string is the
+             "/" separated path of the file relative to dir_name.
     """
-    wait_time = 1
-    while not os.path.exists(file_name):
-        if wait_time >= 256:
-            logging.error("Unable to create {file} within the time limit of 256 seconds.".format(file=file_name))
-            return
-
-        time.sleep(wait_time)
-        wait_time *= 2
+    with os.scandir(dir_name) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from scan_files(entry.path, prefix + entry.name + "/")
+            elif entry.is_file():
+                yield entry, prefix + entry.name
 
 
-def zip_dir(file_name):
+def zip_dir(file_name, dir_name):
     """
     Creates a ZIP file for the binary if target OS is Linux.
 
     :type file_name: str
     :param file_name: The name of the precompiled binary for Linux.
+    :type dir_name: str
+    :param dir_name: The directory containing the precompiled binary for Linux.
+    :return: The name of the ZIP file, which is complete once this function returns.
     """
     logging.debug("Creating a ZIP file for the Linux binary.")
-    shutil.make_archive(file_name, 'zip', "linux")
-
-
-def package_sam_template(linux_bin_name, source_dir, version):
+    zip_name = "{}.zip".format(file_name)
+    # AWS Lambda accepts uncompressed ZIP files, deflating the binary only costs packaging time.
+    with zipfile.ZipFile(zip_name, "w", zipfile.ZIP_STORED) as zip_file:
+        for entry, arcname in scan_files(dir_name):
+            # ZipFile.write copies in 8 KiB chunks, stream the file in with the larger copy buffer instead.
+            zip_info = zipfile.ZipInfo.from_file(entry.path, arcname=arcname)
+            with open(entry.path, "rb") as src, zip_file.open(zip_info, "w") as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+    return zip_name
+
+
+def package_sam_template(linux_zip, source_dir, version):
     """
     Package all relevant artifacts for serverless deployment in a tarball.
 
-    :type linux_bin_name: str
-    :param linux_bin_name: The name of the precompiled binary for Linux.
+    :type linux_zip: str
+    :param linux_zip: The name of the ZIP file containing the precompiled binary for Linux.
     :type source_dir: str
     :param source_dir: The directory containing the SAM template and its documentation.
     :type version: str
@@ -124,17 +221,40 @@ def package_sam_template(linux_bin_name, source_dir, version):
     :return: None
     """
     tarfile_name = "timestream-prometheus-connector-serverless-application-{version}.tar.gz".format(version=version)
-    linux_zip = "{file_name}.zip".format(file_name=linux_bin_name)
 
-    with tarfile.open(tarfile_name, "w:gz") as tar:
-        for root, dirs, files in os.walk(source_dir):
-            for file in files:
-                tar.add(os.path.join(root, file), arcname=file)
-        check_file(linux_zip)
-        tar.add(linux_zip)
+    with open_gzip_tarball(tarfile_name) as tar:
+        for entry, arcname in scan_files(source_dir):
+            # Build the header from the stat result cached on the directory entry instead of letting tar.add stat the
+            # file again.
+            file_stat = entry.stat()
+            tarinfo = tarfile.TarInfo(arcname)
+            tarinfo.size = file_stat.st_size
+            tarinfo.mtime = file_stat.st_mtime
+            tarinfo.mode = stat.S_IMODE(file_stat.st_mode)
+            with open(entry.path, "rb") as file:
+                tar.addfile(tarinfo, file)
+        tar.add(linux_zip, arcname=os.path.basename(linux_zip))
+
+
+@contextlib.contextmanager
+def open_gzip_tarball(file_name):
+    """
+    Opens a gzip compressed tarball for writing. The tarball is written as a stream, without seeking back, and writes
+    to the gzip stream go through a COPY_BUFSIZE buffer, so the many small header and padding blocks written by tarfile
+    are compressed and written out in large batches.
+
+    :type file_name: str
+    :param file_name: The name of the tarball.
+    :return: A context manager yielding the open tarfile.TarFile.
+    """
+    # The tarballs are build artifacts, the fastest compression level gives nearly the same size for much less CPU.
+    with gzip.GzipFile(file_name, "wb", compresslevel=1) as gzip_file, \
+            io.BufferedWriter(gzip_file, buffer_size=COPY_BUFSIZE) as buffered_file, \
+            tarfile.open(fileobj=buffered_file, mode="w|", copybufsize=COPY_BUFSIZE) as tar:
+        yield tar
 
 
-def tar_dir(file_name, dir_name):
+def tar_dir(file_name, dir_name, compress_threads):
     """
     Creates a tarball from the given directory.
 
@@ -142,36 +262,117 @@ def tar_dir(file_name, dir_name):
     :param file_name: The name of the binary.
     :type dir_name: str
     :param dir_name: The name of the directory.
+    :type compress_threads: int
+    :param compress_threads: The number of threads pigz may use to compress the tarball.
     :return: None
     """
-    tar_command = "tar czf {}.tar.gz {}".format(file_name, dir_name)
     logging.debug("Creating a tarball for " + file_name)
-    subprocess.Popen(tar_command, shell=True, stdout=subprocess.PIPE)
+    if PIGZ is not None:
+        tar_with_pigz(file_name, dir_name, compress_threads)
+        return
+
+    with open_gzip_tarball("{}.tar.gz".format(file_name)) as tar:
+        tar.add(dir_name, arcname=os.path.basename(dir_name))
 
 
-def create_tarball(target_folder, version):
+def tar_with_pigz(file_name, dir_name, compress_threads):
+    """
+    Creates a tarball from the given directory by piping tar into pigz, which compresses on multiple threads. If either
+    command fails, both processes are stopped and the partial tarball is removed.
+
+    :type file_name: str
+    :param file_name: The name of the binary.
+    :type dir_name: str
+    :param dir_name: The name of the directory.
+    :type compress_threads: int
+    :param compress_threads: The number of threads pigz may use.
+    :return: None
+    """
+    tarball_name = "{}.tar.gz".format(file_name)
+    tar_command = ["tar", "cf", "-", "-C", os.path.dirname(dir_name), os.path.basename(dir_name)]
+    pigz_command = [PIGZ, "-1", "-p", str(compress_threads)]
+    tar_process = subprocess.Popen(tar_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    pigz_process = None
+    try:
+        with open(tarball_name, "wb") as tarball:
+            # Close the parent's end of the pipe once pigz holds it, so tar gets SIGPIPE if pigz exits early.
+            with tar_process.stdout:
+                pigz_process = subprocess.Popen(pigz_command, stdin=tar_process.stdout, stdout=tarball,
+                                                stderr=subprocess.PIPE)
+            pigz_stderr = pigz_process.communicate()[1]
+        tar_stderr = tar_process.communicate()[1]
+
+        # A failing pigz makes tar die of SIGPIPE, so report pigz first.
+        if pigz_process.returncode != 0:
+            raise subprocess.CalledProcessError(pigz_process.returncode, pigz_command, stderr=pigz_stderr)
+        if tar_process.returncode != 0:
+            raise subprocess.CalledProcessError(tar_process.returncode, tar_command, stderr=tar_stderr)
+    except BaseException:
+        for process in (pigz_process, tar_process):
+            if process is not None:
+                if process.poll() is None:
+                    process.kill()
+                process.wait()
+                process.stderr.close()
+        if os.path.exists(tarball_name):
+            os.remove(tarball_name)
+        raise
+
+
+def create_tarball(staging_dir, target_folder, arch, version, documentation_dir, compress_threads):
     """
     Create a tarball containing a precompiled binary and all documentation.
 
+    :type staging_dir: str
+    :param staging_dir: The staging directory in which the target folder is created.
     :type target_folder: str
     :param target_folder: The temporary folder containing the precompiled binary and all documentation.
+    :type arch: str
+    :param arch: The target architecture for the binary.
     :type version: str
     :param version: The version of the Prometheus Connector.
+    :type documentation_dir: str
+    :param documentation_dir: The directory containing the staged documentation to include in the tarball.
+    :type compress_threads: int
+    :param compress_threads: The number of threads pigz may use to compress the tarball.
     :return: The name of the precompiled binary.
     """
-    create_directory(target_folder)
-    bin_name = run_build(target_folder)
-    if bin_name is None:
-        logging.error("Cannot create binary for packaging.")
-        return
-
-    check_binary(target_folder, bin_name)
-    arch = "amd64"
+    target_dir = os.path.join(staging_dir, target_folder)
+    create_directory(target_dir, documentation_dir)
+    run_build(target_dir, target_folder, arch)
     archive_name = "timestream-prometheus-connector-{}-{}-{}".format(target_folder, arch, version)
-    tar_dir(archive_name, target_folder)
+    tar_dir(archive_name, target_dir, compress_threads)
     return archive_name
 
 
+def package_target(target, arch, version, documentation_dir, compress_threads):
+    """
+    Creates the release artifacts for a single target OS and architecture. For Linux this also creates the ZIP file
+    for AWS Lambda and the serverless application tarball.
+
+    :type target: str
+    :param target: The target OS for the binary.
+    :type arch: str
+    :param arch: The target architecture for the binary.
+    :type version: str
+    :param version: The version of the Prometheus Connector.
+    :type documentation_dir: str
+    :param documentation_dir: The directory containing the staged documentation to include in the tarball.
+    :type compress_threads: int
+    :param compress_threads: The number of threads pigz may use to compress the tarball.
+    :return: None
+    """
+    # Each target is staged in its own temporary directory so concurrent builds and runs never write to the same files.
+    staging_dir = tempfile.mkdtemp(prefix="pkg-{}-{}-".format(target, arch), dir=staging_parent_dir())
+    try:
+        bin_name = create_tarball(staging_dir, target, arch, version, documentation_dir, compress_threads)
+        if target == "linux":
+            linux_zip = zip_dir(bin_name, os.path.join(staging_dir, target))
+            package_sam_template(linux_zip, "./serverless", version)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--version", required=True, help="The connector version")
@@ -179,16 +380,30 @@ if __name__ == "__main__":
 
     connector_version = args.version
     logging.basicConfig(level=logging.INFO)
-    targets = ["windows", "darwin"]
-    linux_file_name = ""
+    targets = ["windows", "darwin", "linux"]
+    archs = ["amd64"]
+    jobs = [(target, arch) for target in targets for arch in archs]
+    # The workers compress concurrently, so share the cores between them instead of giving each pigz all of them.
+    compress_threads = max(1, (os.cpu_count() or 1) // len(jobs))
+    # Staged next to the per-target staging directories, so the documentation can be hard linked into them.
+    documentation_dir = tempfile.mkdtemp(prefix="pkg-docs-", dir=staging_parent_dir())
     try:
-        for target in targets:
-            create_tarball(target, connector_version)
-
-        bin_name = create_tarball("linux", connector_version)
-        zip_dir(bin_name)
-        package_sam_template(bin_name, "./serverless", connector_version)
+        stage_documentation(documentation_dir, list_documentation_files())
+        download_modules()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(package_target, target, arch, connector_version, documentation_dir,
+                                       compress_threads)
+                       for target, arch in jobs]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
         logging.info("Done running script.")
 
+    except subprocess.CalledProcessError as e:
+        logging.error("Command '{}' failed with exit code {}:\n{}".format(
+            " ".join(e.cmd), e.returncode, e.stderr.decode(errors="replace")))
+        sys.exit(1)
     except OSError:
-        logging.error("Failed to create a directory for the compiled binary.")
+        logging.exception("Failed to package the compiled binaries.")
+        sys.exit(1)
+    finally:
+        shutil.rmtree(documentation_dir, ignore_errors=True)